@@ -21,7 +21,9 @@ import json
 import netrc
 import os
 import re
+import subprocess
 import sys
+from multiprocessing.pool import ThreadPool
 try:
   # For python3
   import urllib.error
@@ -37,7 +39,17 @@ except ImportError:
   urllib.parse = urlparse
   urllib.request = urllib2
 
-from xml.etree import ElementTree
+try:
+  import requests
+except ImportError:
+  requests = None
+
+try:
+  # For python2, prefer the C implementation
+  import xml.etree.cElementTree as ElementTree
+except ImportError:
+  # For python3, the accelerator is used automatically
+  from xml.etree import ElementTree
 
 product = sys.argv[1]
 
@@ -46,142 +58,255 @@ if len(sys.argv) > 2:
 else:
     depsonly = None
 
-try:
-    device = product[product.index("_") + 1:]
-except:
+_, separator, device = product.partition("_")
+if not separator:
     device = product
 
-if not depsonly:
-    print("Device %s not found. Attempting to retrieve device repository from LineageOS Github (http://github.com/LineageOS)." % device)
-
-repositories = []
+device_search_re = re.compile(r"android_device_.*_%s$" % re.escape(device))
+device_match_re = re.compile(r"^android_device_[^_]*_%s$" % re.escape(device))
 
 try:
     authtuple = netrc.netrc().authenticators("api.github.com")
 
     if authtuple:
         auth_string = ('%s:%s' % (authtuple[0], authtuple[2])).encode()
-        githubauth = base64.encodestring(auth_string).decode().replace('\n', '')
+        githubauth = base64.b64encode(auth_string).decode()
     else:
         githubauth = None
-except:
+except (IOError, KeyError, netrc.NetrcParseError):
+    # python2 raises KeyError when HOME is unset
     githubauth = None
 
-def add_auth(githubreq):
-    if githubauth:
-        githubreq.add_header("Authorization","Basic %s" % githubauth)
+# headers sent along with every GitHub request
+github_headers = {}
+if githubauth:
+    github_headers["Authorization"] = "Basic %s" % githubauth
 
-if not depsonly:
-    githubreq = urllib.request.Request("https://api.github.com/search/repositories?q=%s+user:LineageOS+in:name+fork:true" % device)
-    add_auth(githubreq)
-    try:
-        result = json.loads(urllib.request.urlopen(githubreq).read().decode())
-    except urllib.error.URLError:
-        print("Failed to search GitHub")
-        sys.exit(1)
-    except ValueError:
-        print("Failed to parse return data from GitHub")
-        sys.exit(1)
-    for res in result.get('items', []):
-        repositories.append(res)
+# With requests available, keep a single connection to GitHub alive
+if requests:
+    github_session = requests.Session()
+    github_session.headers["Accept-Encoding"] = "gzip"
+    github_session.headers.update(github_headers)
+else:
+    github_session = None
+
+# GitHub responses, keyed by URL; treat them as read-only
+github_cache = {}
+
+def get_json(url):
+    if url in github_cache:
+        return github_cache[url]
+
+    if github_session:
+        response = github_session.get(url)
+        response.raise_for_status()
+        result = response.json()
+    else:
+        githubreq = urllib.request.Request(url, headers=github_headers)
+        result = json.load(urllib.request.urlopen(githubreq))
+
+    github_cache[url] = result
+    return result
 
 local_manifests = r'.repo/local_manifests'
 if not os.path.exists(local_manifests): os.makedirs(local_manifests)
 
 def exists_in_tree(lm, path):
-    for child in lm.getchildren():
-        if child.attrib['path'] == path:
-            return True
-    return False
+    return any(child.get('path') == path for child in lm)
+
+# what reading or parsing a missing or broken manifest may raise
+manifest_errors = (IOError, OSError, ElementTree.ParseError)
+
+# parsed manifests, keyed by path and invalidated on modification
+manifest_cache = {}
+
+def parse_manifest(path):
+    '''Parse a manifest and return its root element
+    The same few manifests are consulted for every dependency, so
+    keep the parsed tree around until the file changes on disk.'''
+
+    mtime = os.path.getmtime(path)
+    cached = manifest_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    root = ElementTree.parse(path).getroot()
+    manifest_cache[path] = (mtime, root)
+    return root
+
+# project paths of streamed manifests, cached like manifest_cache
+project_paths_cache = {}
+
+def stream_project_paths(path):
+    '''Collect the project paths listed in a manifest
+    Finished elements are dropped while streaming, so large manifests
+    never sit in memory as a whole tree.'''
+
+    mtime = os.path.getmtime(path)
+    cached = project_paths_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    paths = set()
+    root = None
+    depth = 0
+    for event, elem in ElementTree.iterparse(path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+
+        if elem.tag == "project":
+            paths.add(elem.get("path"))
+        depth -= 1
+        if depth == 1:
+            # a child of the root is complete, detach it
+            root.clear()
+
+    project_paths_cache[path] = (mtime, paths)
+    return paths
 
 # in-place prettyprint formatter
 def indent(elem, level=0):
-    i = "\n" + level*"  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent(elem, level+1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
-
+    if hasattr(ElementTree, 'indent'):
+        # python 3.9+ ships one, except for the tail of the top element
+        ElementTree.indent(elem, level=level)
+        if len(elem) and (not elem.tail or not elem.tail.strip()):
+            elem.tail = "\n" + level*"  "
+        return
+
+    stack = [(elem, level, False)]
+    while stack:
+        elem, level, last = stack.pop()
+        i = "\n" + level*"  "
+        # the last child closes its parent, so it gets the parent's indent
+        tail = "\n" + (level-1)*"  " if last else i
+        if len(elem):
+            if not elem.text or not elem.text.strip():
+                elem.text = i + "  "
+            for child in elem:
+                stack.append((child, level+1, child is elem[-1]))
+        if (len(elem) or level) and (not elem.tail or not elem.tail.strip()):
+            elem.tail = tail
+
+# run a function that takes no arguments only once, then reuse its result
+def run_once(func):
+    result = []
+    def wrapper():
+        if not result:
+            result.append(func())
+        return result[0]
+    return wrapper
+
+@run_once
 def get_manifest_path():
     '''Find the current manifest path
     In old versions of repo this is at .repo/manifest.xml
     In new versions, .repo/manifest.xml includes an include
     to some arbitrary file in .repo/manifests'''
 
-    m = ElementTree.parse(".repo/manifest.xml")
+    m = parse_manifest(".repo/manifest.xml")
     try:
         m.findall('default')[0]
         return '.repo/manifest.xml'
     except IndexError:
         return ".repo/manifests/{}".format(m.find("include").get("name"))
 
+@run_once
 def get_default_revision():
-    m = ElementTree.parse(get_manifest_path())
+    m = parse_manifest(get_manifest_path())
     d = m.findall('default')[0]
     r = d.get('revision')
     return r.replace('refs/heads/', '').replace('refs/tags/', '')
 
-def get_from_manifest(devicename):
+def get_device_project():
     try:
-        lm = ElementTree.parse(".repo/local_manifests/roomservice.xml")
-        lm = lm.getroot()
-    except:
+        lm = parse_manifest(".repo/local_manifests/roomservice.xml")
+    except manifest_errors:
         lm = ElementTree.Element("manifest")
 
     for localpath in lm.findall("project"):
-        if re.search("android_device_.*_%s$" % device, localpath.get("name")):
-            return localpath.get("path")
+        if device_search_re.search(localpath.get("name")):
+            return localpath
 
     return None
 
-def is_in_manifest(projectpath):
+def get_from_manifest(devicename):
+    project = get_device_project()
+    if project is not None:
+        return project.get("path")
+
+    return None
+
+def find_manifest_path():
+    '''Like get_manifest_path(), but return None instead of failing
+    when .repo/manifest.xml is missing or broken'''
+
     try:
-        lm = ElementTree.parse(".repo/local_manifests/roomservice.xml")
-        lm = lm.getroot()
-    except:
-        lm = ElementTree.Element("manifest")
+        return get_manifest_path()
+    except manifest_errors + (AttributeError,):
+        return None
 
-    for localpath in lm.findall("project"):
-        if localpath.get("path") == projectpath:
-            return True
+# project paths known to any manifest, rebuilt after roomservice.xml changes
+known_paths = set()
+known_paths_dirty = True
 
-    # Search in main manifest, too
+def rebuild_known_paths():
+    global known_paths_dirty
+
+    known_paths.clear()
+    for path in [".repo/local_manifests/roomservice.xml", find_manifest_path()]:
+        if not path:
+            continue
+
+        try:
+            lm = parse_manifest(path)
+        except manifest_errors:
+            lm = ElementTree.Element("manifest")
+
+        for localpath in lm.findall("project"):
+            known_paths.add(localpath.get("path"))
+
+    # ... and don't forget the lineage snippet, which is large enough
+    # to stream through rather than keep in memory
     try:
-        lm = ElementTree.parse(get_manifest_path())
-        lm = lm.getroot()
-    except:
-        lm = ElementTree.Element("manifest")
+        known_paths.update(stream_project_paths(".repo/manifests/snippets/lineage.xml"))
+    except manifest_errors:
+        pass
 
-    for localpath in lm.findall("project"):
-        if localpath.get("path") == projectpath:
-            return True
+    known_paths_dirty = False
 
-    # ... and don't forget the lineage snippet
+def quick_contains(path, needle):
     try:
-        lm = ElementTree.parse(".repo/manifests/snippets/lineage.xml")
-        lm = lm.getroot()
-    except:
-        lm = ElementTree.Element("manifest")
+        f = open(path, 'rb')
+    except IOError:
+        return False
+    data = f.read()
+    f.close()
+    return needle.encode() in data
 
-    for localpath in lm.findall("project"):
-        if localpath.get("path") == projectpath:
-            return True
+def is_in_manifest(projectpath):
+    if known_paths_dirty:
+        # A path that appears nowhere in the raw manifests can't be in
+        # them, and doesn't need the known paths rebuilt to tell
+        if not any(path and quick_contains(path, projectpath) for path in
+                   [".repo/local_manifests/roomservice.xml",
+                    find_manifest_path(),
+                    ".repo/manifests/snippets/lineage.xml"]):
+            return False
 
-    return False
+        rebuild_known_paths()
+
+    return projectpath in known_paths
 
 def add_to_manifest(repositories, fallback_branch = None):
+    global known_paths_dirty
+
     try:
         lm = ElementTree.parse(".repo/local_manifests/roomservice.xml")
         lm = lm.getroot()
-    except:
+    except manifest_errors:
         lm = ElementTree.Element("manifest")
 
     for repository in repositories:
@@ -207,28 +332,35 @@ def add_to_manifest(repositories, fallback_branch = None):
         lm.append(project)
 
     indent(lm, 0)
-    raw_xml = ElementTree.tostring(lm).decode()
-    raw_xml = '<?xml version="1.0" encoding="UTF-8"?>\n' + raw_xml
-
-    f = open('.repo/local_manifests/roomservice.xml', 'w')
-    f.write(raw_xml)
+    f = open('.repo/local_manifests/roomservice.xml', 'wb')
+    ElementTree.ElementTree(lm).write(f, encoding='UTF-8', xml_declaration=True)
     f.close()
 
-def fetch_dependencies(repo_path, fallback_branch = None):
+    manifest_cache.pop('.repo/local_manifests/roomservice.xml', None)
+    known_paths_dirty = True
+
+def repo_sync(paths):
+    # keep our own output ahead of repo's
+    sys.stdout.flush()
+    subprocess.call(['repo', 'sync', '--force-sync'] + paths)
+
+def collect_dependencies(repo_path, fallback_branch, syncable_repos, verify_repos):
     print('Looking for dependencies in %s' % repo_path)
     dependencies_path = repo_path + '/lineage.dependencies'
-    syncable_repos = []
-    verify_repos = []
 
     if os.path.exists(dependencies_path):
         dependencies_file = open(dependencies_path, 'r')
-        dependencies = json.loads(dependencies_file.read())
+        dependencies = json.load(dependencies_file)
         fetch_list = []
 
         for dependency in dependencies:
+            if dependency['target_path'] in syncable_repos:
+                # Already queued up by an earlier entry
+                continue
+
             if not is_in_manifest(dependency['target_path']):
                 fetch_list.append(dependency)
-                syncable_repos.append(dependency['target_path'])
+                syncable_repos.add(dependency['target_path'])
                 verify_repos.append(dependency['target_path'])
             else:
                 verify_repos.append(dependency['target_path'])
@@ -241,15 +373,34 @@ def fetch_dependencies(repo_path, fallback_branch = None):
     else:
         print('%s has no additional dependencies.' % repo_path)
 
-    if len(syncable_repos) > 0:
-        print('Syncing dependencies')
-        os.system('repo sync --force-sync %s' % ' '.join(syncable_repos))
-
-    for deprepo in verify_repos:
-        fetch_dependencies(deprepo)
-
-def has_branch(branches, revision):
-    return revision in [branch['name'] for branch in branches]
+def fetch_dependencies(repo_path, fallback_branch = None):
+    # Walk the tree one level at a time, so that everything found on
+    # a level is fetched with a single repo sync. Each repository is
+    # only looked at once, even if several others depend on it.
+    visited = set()
+    pending = [repo_path]
+    while pending:
+        syncable_repos = set()
+        verify_repos = []
+
+        for path in pending:
+            if path in visited:
+                continue
+            visited.add(path)
+            collect_dependencies(path, fallback_branch, syncable_repos, verify_repos)
+
+        # The fallback branch only applies to the device's own dependencies
+        fallback_branch = None
+
+        if len(syncable_repos) > 0:
+            print('Syncing dependencies')
+            repo_sync(sorted(syncable_repos))
+
+        # Don't queue up a level of repositories that were all seen before
+        pending = [path for path in verify_repos if path not in visited]
+
+def branch_names(branches):
+    return set(branch['name'] for branch in branches)
 
 if depsonly:
     repo_path = get_from_manifest(device)
@@ -261,9 +412,41 @@ if depsonly:
     sys.exit()
 
 else:
-    for repository in repositories:
+    # No need to ask GitHub about a device tree we already know about
+    project = get_device_project()
+    if project is not None:
+        repo_path = project.get("path")
+
+        # A device tree on a fallback branch takes its dependencies along
+        fallback_branch = project.get("revision")
+        if fallback_branch == get_default_revision():
+            fallback_branch = None
+
+        # Still sync it, the checkout may be partial or out of date
+        print("Syncing repository to retrieve project.")
+        repo_sync([repo_path])
+        print("Repository synced!")
+
+        fetch_dependencies(repo_path, fallback_branch)
+        print("Done")
+        sys.exit()
+
+    print("Device %s not found. Attempting to retrieve device repository from LineageOS Github (http://github.com/LineageOS)." % device)
+
+    try:
+        result = get_json("https://api.github.com/search/repositories?q=%s+user:LineageOS+in:name+fork:true" % device)
+    except ValueError:
+        # Checked first: requests' JSONDecodeError is an IOError, too
+        print("Failed to parse return data from GitHub")
+        sys.exit(1)
+    except IOError:
+        # Covers both urllib's URLError and requests' RequestException
+        print("Failed to search GitHub")
+        sys.exit(1)
+
+    for repository in result.get('items', []):
         repo_name = repository['name']
-        if re.match(r"^android_device_[^_]*_" + device + "$", repo_name):
+        if device_match_re.match(repo_name):
             print("Found repository: %s" % repository['name'])
             
             manufacturer = repo_name.replace("android_device_", "").replace("_" + device, "")
@@ -271,25 +454,31 @@ else:
             default_revision = get_default_revision()
             print("Default revision: %s" % default_revision)
             print("Checking branch info")
-            githubreq = urllib.request.Request(repository['branches_url'].replace('{/branch}', ''))
-            add_auth(githubreq)
-            result = json.loads(urllib.request.urlopen(githubreq).read().decode())
-
-            ## Try tags, too, since that's what releases use
-            if not has_branch(result, default_revision):
-                githubreq = urllib.request.Request(repository['tags_url'].replace('{/tag}', ''))
-                add_auth(githubreq)
-                result.extend (json.loads(urllib.request.urlopen(githubreq).read().decode()))
+            # Branches and tags are independent, so request them together
+            pool = ThreadPool(2)
+            try:
+                branches = pool.apply_async(get_json, (repository['branches_url'].replace('{/branch}', ''),))
+                tags = pool.apply_async(get_json, (repository['tags_url'].replace('{/tag}', ''),))
+                result = branches.get()
+                names = branch_names(result)
+
+                ## Try tags, too, since that's what releases use
+                if default_revision not in names:
+                    result = result + tags.get()
+                    names = branch_names(result)
+            finally:
+                # Don't wait on the tags if the branches were enough
+                pool.terminate()
             
             repo_path = "device/%s/%s" % (manufacturer, device)
             adding = {'repository':repo_name,'target_path':repo_path}
             
             fallback_branch = None
-            if not has_branch(result, default_revision):
+            if default_revision not in names:
                 if os.getenv('ROOMSERVICE_BRANCHES'):
                     fallbacks = list(filter(bool, os.getenv('ROOMSERVICE_BRANCHES').split(' ')))
                     for fallback in fallbacks:
-                        if has_branch(result, fallback):
+                        if fallback in names:
                             print("Using fallback branch: %s" % fallback)
                             fallback_branch = fallback
                             break
@@ -305,7 +494,7 @@ else:
             add_to_manifest([adding], fallback_branch)
 
             print("Syncing repository to retrieve project.")
-            os.system('repo sync --force-sync %s' % repo_path)
+            repo_sync([repo_path])
             print("Repository synced!")
 
             fetch_dependencies(repo_path, fallback_branch)